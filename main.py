@@ -3,11 +3,15 @@ Telegram-бот для психолога с автоворонкой
 Полная версия с базой данных, экспортом в Excel и автоворонкой
 """
 
+import io
 import os
 import asyncio
+import functools
 import logging
 import sqlite3
-import pandas as pd
+import threading
+import time
+from dataclasses import dataclass
 from datetime import datetime
 from aiogram import Bot, Dispatcher, types, F, Router
 from aiogram.enums import ParseMode
@@ -25,6 +29,11 @@ from aiogram.types import (
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
+from aiogram.webhook.aiohttp_server import (
+    SimpleRequestHandler,
+    setup_application,
+)
+from aiohttp import web
 from dotenv import load_dotenv
 
 # ========== НАСТРОЙКА ЛОГГИРОВАНИЯ ==========
@@ -36,28 +45,61 @@ logger = logging.getLogger(__name__)
 # ========== ЗАГРУЗКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ==========
 load_dotenv()
 
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_ID = os.getenv("ADMIN_ID")
 
-if not BOT_TOKEN:
-    logger.error("❌ ОШИБКА: BOT_TOKEN не найден в переменных окружения!")
-    logger.error(
-        "Добавьте BOT_TOKEN в Environment Variables Replit (иконка 🔒 слева)")
-    exit(1)
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Настройки бота, прочитанные из окружения один раз при запуске"""
+    bot_token: str
+    admin_id: int
+    # Webhook-режим включается переменной WEBHOOK_URL, иначе используется long polling
+    webhook_url: str | None
+    webhook_secret: str | None
+    webhook_port: int
+    # PSYBOT_DEBUG включает отладочный режим event loop (поиск блокирующих вызовов)
+    debug: bool
+
+
+def load_config() -> Config:
+    """Чтение и проверка переменных окружения"""
+    bot_token = os.getenv("BOT_TOKEN")
+    admin_id = os.getenv("ADMIN_ID")
+
+    if not bot_token:
+        logger.error("❌ ОШИБКА: BOT_TOKEN не найден в переменных окружения!")
+        logger.error(
+            "Добавьте BOT_TOKEN в Environment Variables Replit (иконка 🔒 слева)")
+        exit(1)
+
+    if not admin_id:
+        logger.warning(
+            "⚠️  ADMIN_ID не указан. Уведомления админу отправляться не будут.")
+        admin_id = 0
+    else:
+        try:
+            admin_id = int(admin_id)
+        except ValueError:
+            logger.error("❌ ОШИБКА: ADMIN_ID должен быть числом!")
+            admin_id = 0
 
-if not ADMIN_ID:
-    logger.warning(
-        "⚠️  ADMIN_ID не указан. Уведомления админу отправляться не будут.")
-    ADMIN_ID = 0
-else:
-    try:
-        ADMIN_ID = int(ADMIN_ID)
-    except ValueError:
-        logger.error("❌ ОШИБКА: ADMIN_ID должен быть числом!")
-        ADMIN_ID = 0
+    debug = os.getenv("PSYBOT_DEBUG", "").strip().lower() in ("1", "true", "yes")
+
+    return Config(bot_token=bot_token,
+                  admin_id=admin_id,
+                  webhook_url=os.getenv("WEBHOOK_URL"),
+                  webhook_secret=os.getenv("WEBHOOK_SECRET"),
+                  webhook_port=int(os.getenv("PORT", "8080")),
+                  debug=debug)
+
+
+CFG = load_config()
+WEBHOOK_PATH = "/webhook"
+# Порог в секундах, после которого отладочный event loop считает вызов блокирующим
+SLOW_CALLBACK_THRESHOLD = 0.01
+# Сколько секунд ждать отправки отчета о падении, чтобы не зависнуть при сбое сети
+CRASH_NOTIFY_TIMEOUT = 5.0
 
 # ========== ИНИЦИАЛИЗАЦИЯ БОТА ==========
-bot = Bot(token=BOT_TOKEN,
+bot = Bot(token=CFG.bot_token,
           default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
@@ -91,236 +133,414 @@ PROBLEM_NAMES = {
     CallbackData.CUSTOM: "Своя проблема"  # НОВОЕ
 }
 
+# Сколько символов своей проблемы показывать в списке последних заявок /stats
+STATS_CUSTOM_PREVIEW_LEN = 30
+
+# ========== МЕДИАФАЙЛЫ ==========
+WELCOME_PHOTO = "welcome.jpg"
+GUIDE_PDF = "guide.pdf"
+
+# Наличие файлов проверяем один раз при запуске
+WELCOME_EXISTS = os.path.exists(WELCOME_PHOTO)
+GUIDE_EXISTS = os.path.exists(GUIDE_PDF)
+
+# file_id уже загруженных в Telegram файлов — повторно отправляем без загрузки
+_file_ids = {}
+
+
+# ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
+# Последняя отформатированная секунда: [unix-время, строка]
+_now_cache = [0, ""]
+
+
+def _now_str():
+    """Текущее время строкой; strftime вызывается не чаще раза в секунду"""
+    now = int(time.time())
+    if now != _now_cache[0]:
+        _now_cache[:] = [
+            now, datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')
+        ]
+    return _now_cache[1]
+
 
 # ========== ФУНКЦИИ РАБОТЫ С БАЗОЙ ДАННЫХ ==========
-def update_database_schema():
-    """Обновление структуры базы данных при необходимости"""
-    try:
-        conn = sqlite3.connect("/data/psychology_bot.db")
-        cursor = conn.cursor()
+DB_PATH = "/data/psychology_bot.db"
 
-        # Получаем список всех колонок в таблице users
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in cursor.fetchall()]
+# Единое соединение с базой на всё время работы бота (создается в init_database)
+_DB = None
+# Хелперы вызываются из пула потоков, поэтому доступ к соединению сериализуем
+_DB_LOCK = threading.Lock()
 
-        # Добавляем недостающие колонки
-        if 'custom_problem' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN custom_problem TEXT")
-            logger.info("✅ Добавлена колонка 'custom_problem'")
+# SQL-запросы вынесены в константы: один и тот же текст запроса
+# гарантированно попадает в кэш подготовленных выражений sqlite3
+SQL_TABLE_INFO = "PRAGMA table_info(users)"
 
-        if 'age' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN age INTEGER")
-            logger.info("✅ Добавлена колонка 'age'")
+SQL_ADD_USER = """
+    INSERT OR IGNORE INTO users (user_id, username, full_name)
+    VALUES (?, ?, ?)
+"""
 
-        if 'real_name' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN real_name TEXT")
-            logger.info("✅ Добавлена колонка 'real_name'")
+SQL_UPDATE_PROBLEM = """
+    UPDATE users SET problem_segment = ? WHERE user_id = ?
+"""
 
-        conn.commit()
-        conn.close()
-        logger.info("✅ Структура базы данных обновлена")
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка обновления структуры БД: {e}")
-        return False
+SQL_UPDATE_PROBLEM_WITH_CUSTOM = """
+    UPDATE users SET problem_segment = ?, custom_problem = ? WHERE user_id = ?
+"""
 
+# Проблема обновляется только если передана, иначе остается прежней
+SQL_UPDATE_CONTACT = """
+    UPDATE users
+    SET real_name = ?, age = ?, phone = ?,
+        problem_segment = COALESCE(?, problem_segment),
+        custom_problem = COALESCE(?, custom_problem)
+    WHERE user_id = ?
+"""
 
-def init_database():
-    """Инициализация базы данных SQLite"""
-    try:
-        # Сначала удалим старую базу, чтобы создать новую с правильной структурой
-        if os.path.exists("/data/psychology_bot.db"):
-            logger.warning("⚠️  Удаляю старую базу данных для пересоздания...")
-            os.remove("/data/psychology_bot.db")
-            logger.info("✅ Старая база данных удалена")
-
-        conn = sqlite3.connect("/data/psychology_bot.db")
-        cursor = conn.cursor()
-
-        # Создание таблицы пользователей с ВСЕМИ нужными колонками (без комментариев!)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            full_name TEXT NOT NULL,
-            problem_segment TEXT,
-            custom_problem TEXT,
-            real_name TEXT,
-            age INTEGER,
-            phone TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
+SQL_USER_PROBLEM = """
+    SELECT problem_segment, custom_problem FROM users WHERE user_id = ?
+"""
 
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных успешно создана с новой структурой")
+# Оба счетчика одним запросом; число заявок считается по частичному
+# индексу idx_users_requested, а не полным проходом по таблице
+SQL_STATS_TOTALS = """
+    SELECT (SELECT COUNT(*) FROM users) AS total_users,
+           (SELECT COUNT(*) FROM users
+            WHERE real_name IS NOT NULL AND phone IS NOT NULL)
+               AS users_with_requests
+"""
 
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка инициализации базы данных: {e}")
-        return False
+SQL_STATS_PROBLEMS = """
+    SELECT problem_segment, COUNT(*)
+    FROM users
+    WHERE problem_segment IS NOT NULL
+    GROUP BY problem_segment
+    ORDER BY COUNT(*) DESC
+"""
+
+# Условие совпадает с idx_users_requested — последние заявки читаются по индексу
+SQL_STATS_RECENT = """
+    SELECT real_name, age, phone, problem_segment, custom_problem, created_at
+    FROM users
+    WHERE real_name IS NOT NULL AND phone IS NOT NULL
+    ORDER BY created_at DESC
+    LIMIT 5
+"""
+
+# Дату форматирует сама SQLite — без отдельного прохода в Python
+SQL_EXPORT_COLUMNS = """
+    SELECT user_id, username, full_name, problem_segment,
+           custom_problem, real_name, age, phone,
+           strftime('%Y-%m-%d %H:%M:%S', created_at) AS created_at
+    FROM users
+"""
+
+SQL_EXPORT_USERS = SQL_EXPORT_COLUMNS + """
+    ORDER BY users.created_at DESC
+"""
+
+SQL_EXPORT_COUNT = "SELECT COUNT(*) FROM users"
+
+SQL_EXPORT_MONTHS = """
+    SELECT DISTINCT strftime('%Y-%m', created_at) AS month
+    FROM users
+    WHERE created_at IS NOT NULL
+    ORDER BY month DESC
+"""
+
+# Диапазон по created_at вместо strftime() в WHERE, чтобы работал индекс
+SQL_EXPORT_USERS_BY_MONTH = SQL_EXPORT_COLUMNS + """
+    WHERE users.created_at >= ? || '-01'
+      AND users.created_at < date(? || '-01', '+1 month')
+    ORDER BY users.created_at DESC
+"""
+
+# Записи без даты не попадают ни в один месяц — для них отдельный файл
+SQL_EXPORT_USERS_UNDATED = SQL_EXPORT_COLUMNS + """
+    WHERE users.created_at IS NULL
+"""
+
+# Выше этого числа записей экспорт делится на отдельные файлы по месяцам
+EXPORT_SEGMENT_SIZE = 100_000
+# Метка файла с записями без даты создания при помесячном экспорте
+EXPORT_UNDATED_LABEL = "undated"
+
+
+# Повторы записи при занятой базе (SQLITE_BUSY сверх busy_timeout)
+DB_WRITE_RETRIES = 3
+DB_RETRY_DELAY = 0.1
+
+
+async def _db(fn, *args, **kwargs):
+    """Выполнение блокирующей функции в отдельном потоке, не блокируя event loop"""
+    return await asyncio.to_thread(fn, *args, **kwargs)
 
 
-def user_exists(user_id: int) -> bool:
-    """Проверка существования пользователя в базе"""
+def _is_busy_error(error: sqlite3.OperationalError) -> bool:
+    """Временная ли ошибка: база занята другой записью (locked/busy)"""
+    text = str(error)
+    return "locked" in text or "busy" in text
+
+
+def _retry(fn):
+    """Повтор записи при занятой базе с экспоненциальной паузой"""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(DB_WRITE_RETRIES):
+            try:
+                return fn(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                # Постоянные ошибки (нет таблицы, не открыть файл) и
+                # последнюю неудачную попытку отдаем вызывающему коду
+                if not _is_busy_error(e) or attempt == DB_WRITE_RETRIES - 1:
+                    raise
+                logger.warning("⚠️  База занята (%s), повтор через %.1f с",
+                               fn.__name__, DB_RETRY_DELAY * 2**attempt)
+                time.sleep(DB_RETRY_DELAY * 2**attempt)
+
+    return wrapper
+
+
+def get_table_columns():
+    """Получение списка колонок таблицы users"""
+    with _DB_LOCK:
+        return [
+            column["name"] for column in _DB.execute(SQL_TABLE_INFO)
+        ]
+
+
+def update_database_schema():
+    """Обновление структуры базы данных при необходимости"""
     try:
-        conn = sqlite3.connect("/data/psychology_bot.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id, ))
-        exists = cursor.fetchone() is not None
-        conn.close()
-        return exists
+        # Получаем список всех колонок в таблице users
+        columns = get_table_columns()
+
+        with _DB_LOCK, _DB:
+            # Добавляем недостающие колонки
+            if 'custom_problem' not in columns:
+                _DB.execute("ALTER TABLE users ADD COLUMN custom_problem TEXT")
+                logger.info("✅ Добавлена колонка 'custom_problem'")
+
+            if 'age' not in columns:
+                _DB.execute("ALTER TABLE users ADD COLUMN age INTEGER")
+                logger.info("✅ Добавлена колонка 'age'")
+
+            if 'real_name' not in columns:
+                _DB.execute("ALTER TABLE users ADD COLUMN real_name TEXT")
+                logger.info("✅ Добавлена колонка 'real_name'")
+
+            # Индексы для /stats создаем после миграции — они ссылаются на новые колонки
+            _DB.execute("CREATE INDEX IF NOT EXISTS idx_users_problem "
+                        "ON users(problem_segment)")
+            _DB.execute("CREATE INDEX IF NOT EXISTS idx_users_created "
+                        "ON users(created_at DESC)")
+            _DB.execute("CREATE INDEX IF NOT EXISTS idx_users_requested "
+                        "ON users(created_at DESC) "
+                        "WHERE real_name IS NOT NULL AND phone IS NOT NULL")
+
+        logger.info("✅ Структура базы данных обновлена")
+        return True
     except Exception as e:
-        logger.error(f"Ошибка проверки пользователя: {e}")
+        logger.error(f"❌ Ошибка обновления структуры БД: {e}")
         return False
 
 
+def init_database():
+    """Инициализация базы данных SQLite"""
+    global _DB
+    with _DB_LOCK:
+        try:
+            _DB = sqlite3.connect(DB_PATH, check_same_thread=False)
+            _DB.row_factory = sqlite3.Row
+
+            # Создание таблицы пользователей, если ее еще нет.
+            # Недостающие колонки в старых базах добавляет update_database_schema()
+            _DB.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                full_name TEXT NOT NULL,
+                problem_segment TEXT,
+                custom_problem TEXT,
+                real_name TEXT,
+                age INTEGER,
+                phone TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+            _DB.commit()
+
+            # WAL позволяет читать параллельно с записью, остальное — меньше fsync и I/O
+            _DB.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-64000;
+            PRAGMA busy_timeout=5000;
+            """)
+            logger.info("✅ База данных готова к работе")
+
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка инициализации базы данных: {e}")
+            return False
+
+
+@_retry
 def add_user(user_id: int, username: str, full_name: str):
     """Добавление нового пользователя в базу"""
-    try:
-        conn = sqlite3.connect("/data/psychology_bot.db")
-        cursor = conn.cursor()
+    with _DB_LOCK, _DB:
+        cursor = _DB.execute(SQL_ADD_USER, (user_id, username, full_name))
 
-        cursor.execute(
-            """INSERT OR IGNORE INTO users (user_id, username, full_name) 
-               VALUES (?, ?, ?)""", (user_id, username, full_name))
-
-        conn.commit()
-        conn.close()
-        logger.info(f"👤 Добавлен пользователь: {user_id} ({full_name})")
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка добавления пользователя: {e}")
-        return False
+    if cursor.rowcount:
+        logger.info("👤 Добавлен пользователь: %s (%s)", user_id, full_name)
+    return True
 
 
+@_retry
 def update_user_problem(user_id: int,
                         problem_segment: str,
                         custom_problem: str = None):
     """Обновление выбранной проблемы пользователя"""
-    try:
-        conn = sqlite3.connect("/data/psychology_bot.db")
-        cursor = conn.cursor()
-
+    with _DB_LOCK, _DB:
         if custom_problem and problem_segment == CallbackData.CUSTOM:
-            cursor.execute(
-                "UPDATE users SET problem_segment = ?, custom_problem = ? WHERE user_id = ?",
-                (problem_segment, custom_problem, user_id))
-            logger.info(
-                f"🎯 Пользователь {user_id} описал свою проблему: {custom_problem[:50]}..."
-            )
+            _DB.execute(SQL_UPDATE_PROBLEM_WITH_CUSTOM,
+                        (problem_segment, custom_problem, user_id))
+            # Срез строки делаем, только если INFO-сообщение действительно попадет в лог
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("🎯 Пользователь %s описал свою проблему: %s...",
+                            user_id, custom_problem[:50])
         else:
-            cursor.execute(
-                "UPDATE users SET problem_segment = ? WHERE user_id = ?",
-                (problem_segment, user_id))
-            logger.info(
-                f"🎯 Пользователь {user_id} выбрал проблему: {problem_segment}")
-
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка обновления проблемы: {e}")
+            _DB.execute(SQL_UPDATE_PROBLEM, (problem_segment, user_id))
+            logger.info("🎯 Пользователь %s выбрал проблему: %s", user_id,
+                        problem_segment)
+
+    return True
+
+
+@_retry
+def update_user_contact_info(user_id: int,
+                             real_name: str,
+                             age: int,
+                             phone: str,
+                             problem_segment: str = None,
+                             custom_problem: str = None):
+    """Обновление контактной информации пользователя (и проблемы, если указана)
+
+    Возвращает False, если пользователя нет в базе и обновлять нечего.
+    """
+    with _DB_LOCK, _DB:
+        cursor = _DB.execute(SQL_UPDATE_CONTACT,
+                             (real_name, age, phone, problem_segment,
+                              custom_problem, user_id))
+
+    if not cursor.rowcount:
+        logger.error("❌ Пользователь %s не найден, заявка не сохранена",
+                     user_id)
         return False
 
+    logger.info("📝 Обновлены данные пользователя %s: %s, %s лет, %s",
+                user_id, real_name, age, phone)
+    return True
 
-def update_user_contact_info(user_id: int, real_name: str, age: int,
-                             phone: str):
-    """Обновление контактной информации пользователя"""
-    try:
-        conn = sqlite3.connect("/data/psychology_bot.db")
-        cursor = conn.cursor()
 
-        cursor.execute(
-            "UPDATE users SET real_name = ?, age = ?, phone = ? WHERE user_id = ?",
-            (real_name, age, phone, user_id))
+def get_user_problem(user_id: int):
+    """Выбранная пользователем проблема из базы: (problem_segment, custom_problem)"""
+    with _DB_LOCK:
+        row = _DB.execute(SQL_USER_PROBLEM, (user_id, )).fetchone()
 
-        conn.commit()
-        conn.close()
-        logger.info(
-            f"📝 Обновлены данные пользователя {user_id}: {real_name}, {age} лет, {phone}"
-        )
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка обновления данных: {e}")
-        return False
+    if row is None:
+        return None, None
+    return row["problem_segment"], row["custom_problem"]
 
 
 def get_user_stats():
     """Получение статистики по пользователям"""
-    try:
-        conn = sqlite3.connect("/data/psychology_bot.db")
-        cursor = conn.cursor()
+    with _DB_LOCK:
+        totals = _DB.execute(SQL_STATS_TOTALS).fetchone()
+        problems_distribution = _DB.execute(SQL_STATS_PROBLEMS).fetchall()
+        recent_requests = _DB.execute(SQL_STATS_RECENT).fetchall()
+
+    stats = {
+        "total_users": totals["total_users"],
+        "users_with_requests": totals["users_with_requests"],
+        "problems_distribution": problems_distribution,
+        "recent_requests": recent_requests
+    }
 
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
+    return stats
 
-        cursor.execute(
-            "SELECT COUNT(*) FROM users WHERE real_name IS NOT NULL AND phone IS NOT NULL"
-        )
-        users_with_requests = cursor.fetchone()[0]
-
-        cursor.execute("""
-            SELECT problem_segment, COUNT(*) 
-            FROM users 
-            WHERE problem_segment IS NOT NULL 
-            GROUP BY problem_segment 
-            ORDER BY COUNT(*) DESC
-        """)
-        problems_distribution = cursor.fetchall()
-
-        cursor.execute("""
-            SELECT real_name, age, phone, problem_segment, custom_problem, created_at 
-            FROM users 
-            WHERE real_name IS NOT NULL 
-            ORDER BY created_at DESC 
-            LIMIT 5
-        """)
-        recent_requests = cursor.fetchall()
-
-        conn.close()
-
-        stats = {
-            "total_users": total_users,
-            "users_with_requests": users_with_requests,
-            "problems_distribution": problems_distribution,
-            "recent_requests": recent_requests
-        }
-
-        return stats
-    except Exception as e:
-        logger.error(f"❌ Ошибка получения статистики: {e}")
-        return None
 
+def _write_workbook(cursor):
+    """Запись строк курсора в книгу Excel в памяти: (содержимое, число строк)"""
+    # Импорт по требованию: /export вызывается редко, а старт бота быстрее
+    import xlsxwriter
 
-def export_users_to_excel():
-    """Экспорт всех пользователей в Excel файл"""
-    try:
-        conn = sqlite3.connect("/data/psychology_bot.db")
+    first_row = cursor.fetchone()
+    if first_row is None:
+        return None, 0
 
-        df = pd.read_sql_query("SELECT * FROM users ORDER BY created_at DESC",
-                               conn)
+    # constant_memory: строки сбрасываются во временные файлы по мере записи,
+    # память не растет с размером таблицы; готовый .xlsx пишется в буфер
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    worksheet.write_row(0, 0, [column[0] for column in cursor.description])
+    worksheet.write_row(1, 0, first_row)
 
-        conn.close()
+    row_number = 1
+    for row_number, row in enumerate(cursor, start=2):
+        worksheet.write_row(row_number, 0, row)
 
-        if df.empty:
-            return None, "База данных пуста"
+    workbook.close()
+    return buffer.getvalue(), row_number
 
-        if 'created_at' in df.columns:
-            df['created_at'] = pd.to_datetime(
-                df['created_at']).dt.strftime('%Y-%m-%d %H:%M:%S')
 
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"clients_database_{timestamp}.xlsx"
+def _open_export_connection():
+    """Отдельное соединение только для чтения для экспорта"""
+    # В режиме WAL читатель не блокирует запись, поэтому экспорт идет
+    # без _DB_LOCK и не задерживает обработчики, пишущие в базу
+    connection = sqlite3.connect(f"file:{DB_PATH}?mode=ro",
+                                 uri=True,
+                                 isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    return connection
 
-        df.to_excel(filename, index=False, engine='openpyxl')
 
-        logger.info(f"📊 Экспортировано {len(df)} записей в файл {filename}")
-        return filename, None
-    except Exception as e:
-        logger.error(f"❌ Ошибка экспорта в Excel: {e}")
-        return None, str(e)
+def get_export_segments():
+    """Разбивка экспорта на файлы: (всего записей, список сегментов)
+
+    Сегмент — тройка (метка, запрос, параметры). Пока записей не больше
+    EXPORT_SEGMENT_SIZE, файл один и метка равна None; иначе файл на каждый
+    месяц и отдельный файл EXPORT_UNDATED_LABEL для записей без даты.
+    """
+    connection = _open_export_connection()
+    try:
+        total = connection.execute(SQL_EXPORT_COUNT).fetchone()[0]
+
+        if total <= EXPORT_SEGMENT_SIZE:
+            return total, [(None, SQL_EXPORT_USERS, ())]
+
+        months = [
+            row["month"] for row in connection.execute(SQL_EXPORT_MONTHS)
+        ]
+    finally:
+        connection.close()
+
+    segments = [(month, SQL_EXPORT_USERS_BY_MONTH, (month, month))
+                for month in months]
+    segments.append((EXPORT_UNDATED_LABEL, SQL_EXPORT_USERS_UNDATED, ()))
+    return total, segments
+
+
+def build_export_segment(query: str, params: tuple):
+    """Книга Excel для одного сегмента экспорта: (содержимое, число строк)"""
+    connection = _open_export_connection()
+    try:
+        return _write_workbook(connection.execute(query, params))
+    finally:
+        connection.close()
 
 
 # ========== ФУНКЦИИ ДЛЯ СОЗДАНИЯ КЛАВИАТУР ==========
@@ -364,6 +584,62 @@ def create_signup_keyboard():
     return builder.as_markup()
 
 
+# Клавиатуры не меняются, поэтому собираем их один раз при запуске
+MAIN_KEYBOARD = create_main_keyboard()
+PROBLEMS_KEYBOARD = create_problems_keyboard()
+SIGNUP_KEYBOARD = create_signup_keyboard()
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+
+# ========== ТЕКСТЫ СООБЩЕНИЙ ==========
+# Приветствие: между началом и концом подставляется только имя пользователя
+WELCOME_HEAD = "👋 <b>Здравствуйте, "
+WELCOME_TAIL = ("!</b>\n\n"
+                "Я — цифровой помощник профессионального психолога.\n\n"
+                "🎯 <b>Я помогу вам:</b>\n"
+                "• Получить бесплатный гайд по работе с тревогой\n"
+                "• Определить вашу основную проблема\n"
+                "• Записаться на бесплатную 15-минутную консультацию\n\n"
+                "👉 <b>Выберите действие ниже:</b>")
+
+HELP_TEXT = (
+    "📚 <b>СПРАВКА ПО КОМАНДАМ</b>\n\n"
+    "🎯 <b>Для всех пользователей:</b>\n"
+    "• /start - Начать работу с ботом\n"
+    "• /help - Показать эту справку\n\n"
+    "🎯 <b>Основные действия (через меню):</b>\n"
+    "• 🎁 Получить бесплатный гайд - получить PDF-гайд и выбрать проблему\n"
+    "• 📞 Записаться на консультацию - прямой переход к записи\n"
+    "• ℹ️  О психологе - информация о специалисте\n\n"
+    "🔄 <b>Автоворонка:</b>\n"
+    "1. Получите гайд\n"
+    "2. Выберите проблему (или опишите свою)\n"
+    "3. Укажите имя, возраст и Telegram username\n"
+    "4. Оставьте заявку на бесплатную консультацию\n\n"
+    "📝 <b>О проблемах:</b>\n"
+    "• Можно выбрать из предложенных вариантов\n"
+    "• Или подробно описать свою ситуацию\n\n"
+    "👨‍💼 <b>Административные команды:</b>\n"
+    "• /stats - Статистика бота\n"
+    "• /export - Экспорт базы данных в Excel\n\n"
+    "<i>Консультации проходят в Telegram для вашего удобства.</i>")
+
+TEST_TEXT = ("✅ <b>Тест пройден успешно!</b>\n\n"
+             "Бот работает корректно.")
+
+FALLBACK_TEXT = (
+    "🤖 <b>Я — бот-помощник психолога.</b>\n\n"
+    "Чтобы начать работу, нажмите /start или выберите действие в меню.\n\n"
+    "Для справки нажмите /help")
+
+# Уведомление администратору о запуске: подставляется только время
+STARTUP_TEMPLATE = ("🤖 <b>Бот психолога успешно запущен!</b>\n\n"
+                    "⏰ <b>Время запуска:</b> {ts}\n"
+                    "📍 <b>Платформа:</b> Replit\n"
+                    "✅ <b>Статус:</b> Активен и готов к работе\n\n"
+                    "<i>Для проверки работы отправьте боту /start</i>")
+
+
 # ========== ОБРАБОТЧИКИ КОМАНД ==========
 @router.message(Command("start"))
 async def command_start(message: types.Message):
@@ -372,92 +648,62 @@ async def command_start(message: types.Message):
     username = message.from_user.username or "не указан"
     full_name = message.from_user.full_name
 
-    logger.info(f"🚀 Пользователь {user_id} ({full_name}) запустил бота")
+    logger.info("🚀 Пользователь %s (%s) запустил бота", user_id, full_name)
 
-    # Удаляем старую базу если есть проблемы
-    if not os.path.exists("/data/psychology_bot.db"):
-        init_database()
-    else:
-        # Проверяем структуру базы
-        try:
-            conn = sqlite3.connect("/data/psychology_bot.db")
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [column[1] for column in cursor.fetchall()]
-            conn.close()
-
-            required_columns = ['custom_problem', 'age', 'real_name']
-            missing_columns = [
-                col for col in required_columns if col not in columns
-            ]
-
-            if missing_columns:
-                logger.warning(
-                    f"⚠️  В базе отсутствуют колонки: {missing_columns}")
-                logger.warning("Удаляю старую базу для пересоздания...")
-                os.remove("/data/psychology_bot.db")
-                init_database()
-        except:
-            # Если ошибка при проверке, пересоздаем базу
-            if os.path.exists("/data/psychology_bot.db"):
-                os.remove("/data/psychology_bot.db")
-            init_database()
-
-    if not user_exists(user_id):
-        add_user(user_id, username, full_name)
-
-    welcome_text = ("👋 <b>Здравствуйте, {name}!</b>\n\n"
-                    "Я — цифровой помощник профессионального психолога.\n\n"
-                    "🎯 <b>Я помогу вам:</b>\n"
-                    "• Получить бесплатный гайд по работе с тревогой\n"
-                    "• Определить вашу основную проблема\n"
-                    "• Записаться на бесплатную 15-минутную консультацию\n\n"
-                    "👉 <b>Выберите действие ниже:</b>").format(
-                        name=full_name.split()[0] if full_name else "друг")
-
-    keyboard = create_main_keyboard()
+    # Сбой записи не должен оставить пользователя без приветствия
+    try:
+        await _db(add_user, user_id, username, full_name)
+    except sqlite3.Error as e:
+        logger.error(f"❌ Не удалось добавить пользователя {user_id}: {e}")
+
+    welcome_text = (WELCOME_HEAD + (full_name.partition(" ")[0] or "друг") +
+                    WELCOME_TAIL)
 
     try:
-        if os.path.exists("welcome.jpg"):
-            photo = FSInputFile("welcome.jpg")
-            await message.answer_photo(photo=photo,
-                                       caption=welcome_text,
-                                       reply_markup=keyboard)
+        if WELCOME_EXISTS:
+            photo = _file_ids.get(WELCOME_PHOTO) or FSInputFile(WELCOME_PHOTO)
+            sent = await message.answer_photo(photo=photo,
+                                              caption=welcome_text,
+                                              reply_markup=MAIN_KEYBOARD)
+            _file_ids[WELCOME_PHOTO] = sent.photo[-1].file_id
         else:
-            await message.answer(welcome_text, reply_markup=keyboard)
+            await message.answer(welcome_text, reply_markup=MAIN_KEYBOARD)
     except Exception as e:
         logger.error(f"Ошибка отправки фото: {e}")
-        await message.answer(welcome_text, reply_markup=keyboard)
+        await message.answer(welcome_text, reply_markup=MAIN_KEYBOARD)
 
 
 @router.message(F.text == "🎁 Получить бесплатный гайд")
 async def handle_get_guide(message: types.Message):
     """Обработчик получения лид-магнита"""
     user_id = message.from_user.id
-    logger.info(f"📥 Пользователь {user_id} запросил гайд")
+    logger.info("📥 Пользователь %s запросил гайд", user_id)
 
     try:
-        if os.path.exists("guide.pdf"):
-            pdf_file = FSInputFile("guide.pdf")
-            await message.answer_document(
-                document=pdf_file,
+        pdf_file = _file_ids.get(GUIDE_PDF)
+        if GUIDE_EXISTS:
+            sent = await message.answer_document(
+                document=pdf_file or FSInputFile(GUIDE_PDF),
                 caption=
                 ("✅ <b>Ваш бесплатный гайд готов!</b>\n\n"
                  "📖 <i>«Как справиться с тревогой: 5 практических шагов»</i>\n\n"
                  "Скачайте и откройте файл. Пока вы знакомитесь с материалом, "
                  "ответьте на один важный вопрос:"))
         else:
-            pdf_content = (
-                "Бесплатный гайд: Как справиться с тревогой\n\n"
-                "1. Практика глубокого дыхания\n2. Ведение дневника мыслей\n"
-                "3. Регулярная физическая активность\n4. Техники осознанности\n"
-                "5. Поиск профессиональной помощи\n\n"
-                "Это демонстрационный файл.").encode('utf-8')
-
-            pdf_file = BufferedInputFile(pdf_content, filename="guide.pdf")
-            await message.answer_document(
+            if not pdf_file:
+                pdf_content = (
+                    "Бесплатный гайд: Как справиться с тревогой\n\n"
+                    "1. Практика глубокого дыхания\n2. Ведение дневника мыслей\n"
+                    "3. Регулярная физическая активность\n4. Техники осознанности\n"
+                    "5. Поиск профессиональной помощи\n\n"
+                    "Это демонстрационный файл.").encode('utf-8')
+                pdf_file = BufferedInputFile(pdf_content, filename=GUIDE_PDF)
+
+            sent = await message.answer_document(
                 document=pdf_file,
                 caption="✅ <b>Ваш бесплатный гайд готов!</b>")
+
+        _file_ids[GUIDE_PDF] = sent.document.file_id
     except Exception as e:
         logger.error(f"❌ Ошибка отправки PDF: {e}")
         await message.answer(
@@ -468,11 +714,10 @@ async def handle_get_guide(message: types.Message):
         "📝 <b>Пока вы открываете гайд, ответьте на один вопрос:</b>\n\n"
         "<i>Что вас беспокоит сейчас сильнее всего?</i>\n\n"
         "Вы можете выбрать из предложенных вариантов или написать свою проблему.",
-        reply_markup=ReplyKeyboardRemove())
+        reply_markup=REMOVE_KEYBOARD)
 
-    keyboard = create_problems_keyboard()
     await message.answer("Выберите наиболее подходящий вариант:",
-                         reply_markup=keyboard)
+                         reply_markup=PROBLEMS_KEYBOARD)
 
 
 @router.message(F.text == "📞 Записаться на консультацию")
@@ -482,10 +727,9 @@ async def handle_direct_signup(message: types.Message):
         "📋 <b>Отлично! Вы хотите записаться на консультацию.</b>\n\n"
         "Для начала расскажите, что вас беспокоит?\n\n"
         "<i>Выберите из вариантов или опишите свою ситуацию:</i>",
-        reply_markup=ReplyKeyboardRemove())
+        reply_markup=REMOVE_KEYBOARD)
 
-    keyboard = create_problems_keyboard()
-    await message.answer("Выберите вариант:", reply_markup=keyboard)
+    await message.answer("Выберите вариант:", reply_markup=PROBLEMS_KEYBOARD)
 
 
 @router.message(F.text == "ℹ️  О психологе")
@@ -511,13 +755,20 @@ async def handle_about(message: types.Message):
 @router.callback_query(
     F.data.in_(
         [CallbackData.ANXIETY, CallbackData.RELATIONS, CallbackData.SELF]))
-async def handle_problem_selection(callback: types.CallbackQuery):
+async def handle_problem_selection(callback: types.CallbackQuery,
+                                   state: FSMContext):
     """Обработка выбора стандартной проблемы"""
     user_id = callback.from_user.id
     problem_key = callback.data
     problem_name = PROBLEM_NAMES.get(problem_key, "Неизвестная проблема")
 
-    update_user_problem(user_id, problem_name)
+    # Проблема еще раз запишется вместе с контактами, поэтому сбой не критичен
+    try:
+        await _db(update_user_problem, user_id, problem_name)
+    except sqlite3.Error as e:
+        logger.error(f"❌ Не удалось сохранить проблему {user_id}: {e}")
+    # Запоминаем проблему в состоянии — она понадобится при оформлении заявки
+    await state.update_data(problem_segment=problem_name, custom_problem=None)
 
     responses = {
         CallbackData.ANXIETY:
@@ -541,9 +792,9 @@ async def handle_problem_selection(callback: types.CallbackQuery):
         f"• Определим вашу текущую ситуацию\n"
         f"• Наметим возможные пути решения")
 
-    keyboard = create_signup_keyboard()
     await callback.message.answer(
-        "Нажмите кнопку ниже, чтобы оставить заявку:", reply_markup=keyboard)
+        "Нажмите кнопку ниже, чтобы оставить заявку:",
+        reply_markup=SIGNUP_KEYBOARD)
 
     await callback.answer()
 
@@ -559,7 +810,7 @@ async def handle_custom_problem_start(callback: types.CallbackQuery,
         "• 'Чувствую постоянную усталость и нет интереса к жизни'\n"
         "• 'Сложности на работе, конфликты с коллегами'\n"
         "• 'Не могу найти общий язык с подростком-сыном'</i>",
-        reply_markup=ReplyKeyboardRemove())
+        reply_markup=REMOVE_KEYBOARD)
 
     # Устанавливаем состояние ожидания описания проблемы
     await state.set_state(Form.custom_problem)
@@ -581,7 +832,13 @@ async def handle_custom_problem_input(message: types.Message,
     user_id = message.from_user.id
 
     # Сохраняем свою проблему в базе
-    update_user_problem(user_id, CallbackData.CUSTOM, custom_problem)
+    try:
+        await _db(update_user_problem, user_id, CallbackData.CUSTOM,
+                  custom_problem)
+    except sqlite3.Error as e:
+        logger.error(f"❌ Не удалось сохранить проблему {user_id}: {e}")
+    await state.update_data(problem_segment=CallbackData.CUSTOM,
+                            custom_problem=custom_problem)
 
     await message.answer(
         "✅ <b>Спасибо за откровенность!</b>\n\n"
@@ -590,12 +847,11 @@ async def handle_custom_problem_input(message: types.Message,
         "Я специализируюсь на разных вопросах и помогу разобраться в вашей ситуации."
     )
 
-    keyboard = create_signup_keyboard()
     await message.answer("Нажмите кнопку ниже, чтобы оставить заявку:",
-                         reply_markup=keyboard)
+                         reply_markup=SIGNUP_KEYBOARD)
 
-    # Сбрасываем состояние
-    await state.clear()
+    # Выходим из состояния, сохраняя данные о проблеме для заявки
+    await state.set_state(None)
 
 
 @router.callback_query(F.data == CallbackData.SIGNUP)
@@ -688,35 +944,42 @@ async def handle_phone_input(message: types.Message, state: FSMContext):
     name = data.get("name", "Не указано")
     age = data.get("age", 0)
 
-    # Получаем информацию о проблеме из базы данных
+    problem_segment = data.get("problem_segment")
+    custom_problem = data.get("custom_problem")
+
     try:
-        conn = sqlite3.connect("/data/psychology_bot.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT problem_segment, custom_problem FROM users WHERE user_id = ?",
-            (user_id, ))
-        user_data = cursor.fetchone()
-        conn.close()
-
-        if user_data:
-            problem_segment = user_data[0] if user_data[0] else "не указана"
-            custom_problem = user_data[1]
-
-            # Формируем полное описание проблемы
-            if problem_segment == CallbackData.CUSTOM and custom_problem:
-                problem_display = f"Своя проблема: {custom_problem[:100]}..."
-            elif problem_segment in PROBLEM_NAMES:
-                problem_display = PROBLEM_NAMES.get(problem_segment)
-            else:
-                problem_display = problem_segment
-        else:
-            problem_display = "не указана"
-    except Exception as e:
-        logger.error(f"❌ Ошибка получения данных о проблеме: {e}")
-        problem_display = "не удалось определить"
+        # Данные FSM в MemoryStorage теряются при перезапуске, а после
+        # state.clear() их нет вовсе — тогда берем проблему из базы
+        if problem_segment is None:
+            problem_segment, custom_problem = await _db(
+                get_user_problem, user_id)
+
+        # Сохраняем данные в базе (username сохраняем в поле phone)
+        # Контакты и проблема записываются одним UPDATE в одной транзакции
+        saved = await _db(update_user_contact_info, user_id, name, age,
+                          telegram_username, problem_segment, custom_problem)
+    except sqlite3.Error as e:
+        logger.error(f"❌ Не удалось сохранить заявку {user_id}: {e}")
+        saved = False
+
+    # Без записи в базе заявку не подтверждаем и админа не уведомляем;
+    # состояние не сбрасываем, чтобы username можно было отправить еще раз
+    if not saved:
+        await message.answer(
+            "❌ <b>Не удалось сохранить заявку.</b>\n\n"
+            "Пожалуйста, отправьте username еще раз через минуту "
+            "или начните заново с /start")
+        return
 
-    # Сохраняем данные в базе (username сохраняем в поле phone)
-    update_user_contact_info(user_id, name, age, telegram_username)
+    invalidate_stats_cache()
+
+    # Формируем полное описание проблемы
+    if problem_segment == CallbackData.CUSTOM and custom_problem:
+        problem_display = f"Своя проблема: {custom_problem[:100]}..."
+    elif problem_segment in PROBLEM_NAMES:
+        problem_display = PROBLEM_NAMES.get(problem_segment)
+    else:
+        problem_display = problem_segment or "не указана"
 
     await message.answer(
         "🎉 <b>Спасибо! Заявка успешно принята!</b>\n\n"
@@ -728,15 +991,11 @@ async def handle_phone_input(message: types.Message, state: FSMContext):
         "3. Проведем бесплатную диагностику вашей ситуации\n\n"
         "💬 <b>Ожидайте сообщения в Telegram от @yrvrs!</b>\n\n"
         "Если у вас есть срочный вопрос, напишите мне в Telegram: @yrvrs",
-        reply_markup=ReplyKeyboardRemove())
+        reply_markup=REMOVE_KEYBOARD)
 
     # Уведомление администратору
-    if ADMIN_ID:
+    if CFG.admin_id:
         try:
-            # Если problem_display не определен, используем fallback
-            if 'problem_display' not in locals():
-                problem_display = "не указана"
-
             admin_message = (
                 "🔔 <b>НОВАЯ ЗАЯВКА НА КОНСУЛЬТАЦИЮ!</b>\n\n"
                 f"👤 <b>Имя:</b> {name}\n"
@@ -744,224 +1003,320 @@ async def handle_phone_input(message: types.Message, state: FSMContext):
                 f"🎯 <b>Проблема:</b> {problem_display}\n"
                 f"📱 <b>Telegram:</b> @{telegram_username}\n"
                 f"🆔 <b>User ID:</b> {user_id}\n\n"
-                f"⏰ <b>Время:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+                f"⏰ <b>Время:</b> {_now_str()}"
             )
 
-            await bot.send_message(chat_id=ADMIN_ID, text=admin_message)
-            logger.info(f"📨 Уведомление отправлено администратору {ADMIN_ID}")
+            await bot.send_message(chat_id=CFG.admin_id, text=admin_message)
+            logger.info("📨 Уведомление отправлено администратору %s",
+                        CFG.admin_id)
         except Exception as e:
             logger.error(f"❌ Не удалось отправить уведомление админу: {e}")
 
-    logger.info(
-        f"✅ Заявка сохранена: {user_id} - {name}, {age} лет, @{telegram_username}"
-    )
+    logger.info("✅ Заявка сохранена: %s - %s, %s лет, @%s", user_id, name, age,
+                telegram_username)
 
     # Сбрасываем состояние
     await state.clear()
 
 
+# ========== КЭШ СТАТИСТИКИ ==========
+STATS_CACHE_TTL = 30  # секунд
+
+# Готовый текст /stats; version увеличивается при каждой новой заявке
+_stats_cache = {"text": None, "ts": 0.0, "version": 0, "text_version": -1}
+
+
+def invalidate_stats_cache():
+    """Сброс кэша /stats (вызывается после сохранения новой заявки)"""
+    _stats_cache["version"] += 1
+
+
+async def get_stats_text():
+    """Текст статистики для /stats, кэшируется на STATS_CACHE_TTL секунд"""
+    now = time.monotonic()
+    version = _stats_cache["version"]
+    if (_stats_cache["text"] is not None
+            and _stats_cache["text_version"] == version
+            and now - _stats_cache["ts"] < STATS_CACHE_TTL):
+        return _stats_cache["text"]
+
+    stats = await _db(get_user_stats)
+
+    # Текст собирается списком и склеивается один раз в конце
+    parts = [
+        "📈 <b>СТАТИСТИКА БОТА</b>\n\n"
+        f"👥 <b>Всего пользователей:</b> {stats['total_users']}\n"
+        f"📝 <b>Заявок оставлено:</b> {stats['users_with_requests']}\n"
+        f"📊 <b>Конверсия:</b> {round(stats['users_with_requests'] / stats['total_users'] * 100, 1) if stats['total_users'] > 0 else 0}%\n\n"
+    ]
+    append = parts.append
+
+    # Локальная ссылка на метод вместо поиска атрибута на каждой строке
+    get_problem_name = PROBLEM_NAMES.get
+
+    if stats['problems_distribution']:
+        append("<b>Распределение по проблемам:</b>\n")
+        for problem, count in stats['problems_distribution']:
+            percentage = round(count / stats['total_users'] *
+                               100, 1) if stats['total_users'] > 0 else 0
+            problem_name = get_problem_name(problem, problem)
+            append(f"• {problem_name}: {count} ({percentage}%)\n")
+
+    if stats['recent_requests']:
+        append("\n<b>Последние заявки:</b>\n")
+        # Не больше 5 строк — ограничение LIMIT уже в SQL_STATS_RECENT
+        for name, age, telegram, problem, custom_problem, created_at in stats[
+                'recent_requests']:
+            if problem == CallbackData.CUSTOM and custom_problem:
+                preview = custom_problem[:STATS_CUSTOM_PREVIEW_LEN]
+                problem_display = f"Своя: {preview}..."
+            else:
+                problem_display = get_problem_name(problem, problem)
+            append(f"• {name} ({age} лет) - @{telegram} - {problem_display}\n")
+
+    append(f"\n⏰ <i>Обновлено: {_now_str()}</i>")
+    stats_text = "".join(parts)
+
+    _stats_cache.update(text=stats_text, ts=now, text_version=version)
+    return stats_text
+
+
 # ========== АДМИНИСТРАТИВНЫЕ КОМАНДЫ ==========
-@router.message(Command("export"))
-async def command_export(message: types.Message):
-    """Экспорт базы данных в Excel"""
-    user_id = message.from_user.id
+# Фильтр собирается один раз: команды не от админа отсекаются роутером
+# до вызова обработчика и без обращений к БД, а отказ отправляет
+# command_admin_denied ниже
+IS_ADMIN = F.from_user.id == CFG.admin_id
 
-    if user_id != ADMIN_ID:
-        await message.answer(
-            "⛔ <b>У вас нет прав для выполнения этой команды.</b>")
-        return
 
+@router.message(Command("export"), IS_ADMIN)
+async def command_export(message: types.Message):
+    """Экспорт базы данных в Excel"""
     await message.answer("📊 <b>Начинаю экспорт базы данных...</b>\n\n"
                          "<i>Это может занять несколько секунд.</i>")
 
-    filename, error = export_users_to_excel()
-
-    if error:
+    # Одно время экспорта и для имени файла, и для подписи
+    export_time = datetime.now()
+    try:
+        total, segments = await asyncio.to_thread(get_export_segments)
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка экспорта в Excel: {e}")
         await message.answer(
-            f"❌ <b>Ошибка при экспорте:</b>\n\n<code>{error}</code>")
+            f"❌ <b>Ошибка при экспорте:</b>\n\n<code>{e}</code>")
         return
 
-    if not filename:
+    if not total:
         await message.answer("📭 <b>База данных пуста.</b>\n\n"
                              "Нет данных для экспорта.")
         return
 
     try:
-        excel_file = FSInputFile(filename)
-        stats = get_user_stats()
+        stats = await _db(get_user_stats)
 
         caption = (
             f"📁 <b>База данных клиентов</b>\n\n"
             f"📊 <b>Статистика:</b>\n"
-            f"• Всего пользователей: {stats['total_users'] if stats else 0}\n"
-            f"• Заявок оставлено: {stats['users_with_requests'] if stats else 0}\n\n"
+            f"• Всего пользователей: {stats['total_users']}\n"
+            f"• Заявок оставлено: {stats['users_with_requests']}\n\n"
             f"⏰ <b>Экспорт выполнен:</b>\n"
-            f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-
-        await message.answer_document(document=excel_file, caption=caption)
-
-        os.remove(filename)
-        logger.info(f"🗑️ Файл {filename} удален")
-
+            f"{export_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+        # Большая база приходит несколькими файлами — по одному на месяц.
+        # Файл отправляется до сборки следующего: в памяти всегда один сегмент
+        stamp = export_time.strftime('%Y%m%d_%H%M%S')
+        exported = files = 0
+        for month, query, params in segments:
+            data, rows = await asyncio.to_thread(build_export_segment, query,
+                                                 params)
+            if data is None:
+                continue
+
+            suffix = f"_{month}" if month else ""
+            await message.answer_document(
+                document=BufferedInputFile(
+                    data, filename=f"clients_database_{stamp}{suffix}.xlsx"),
+                caption=caption)
+            del data
+            caption = None
+            exported += rows
+            files += 1
+
+        logger.info("📊 Экспортировано %s из %s записей в %s файл(ов)",
+                    exported, total, files)
+
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка экспорта в Excel: {e}")
+        await message.answer(
+            f"❌ <b>Ошибка при экспорте:</b>\n\n<code>{e}</code>")
     except Exception as e:
         logger.error(f"❌ Ошибка отправки файла: {e}")
         await message.answer(
             f"❌ <b>Ошибка отправки файла:</b>\n\n<code>{str(e)}</code>")
 
 
-@router.message(Command("stats"))
+@router.message(Command("stats"), IS_ADMIN)
 async def command_stats(message: types.Message):
     """Показать статистику бота"""
-    user_id = message.from_user.id
-
-    if user_id != ADMIN_ID:
-        await message.answer(
-            "⛔ <b>У вас нет прав для выполнения этой команды.</b>")
-        return
-
-    stats = get_user_stats()
-
-    if not stats:
+    try:
+        stats_text = await get_stats_text()
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка получения статистики: {e}")
         await message.answer("❌ <b>Не удалось получить статистику.</b>")
         return
 
-    stats_text = (
-        "📈 <b>СТАТИСТИКА БОТА</b>\n\n"
-        f"👥 <b>Всего пользователей:</b> {stats['total_users']}\n"
-        f"📝 <b>Заявок оставлено:</b> {stats['users_with_requests']}\n"
-        f"📊 <b>Конверсия:</b> {round(stats['users_with_requests'] / stats['total_users'] * 100, 1) if stats['total_users'] > 0 else 0}%\n\n"
-    )
-
-    if stats['problems_distribution']:
-        stats_text += "<b>Распределение по проблемам:</b>\n"
-        for problem, count in stats['problems_distribution']:
-            percentage = round(count / stats['total_users'] *
-                               100, 1) if stats['total_users'] > 0 else 0
-            problem_name = PROBLEM_NAMES.get(problem, problem)
-            stats_text += f"• {problem_name}: {count} ({percentage}%)\n"
-
-    if stats['recent_requests']:
-        stats_text += "\n<b>Последние заявки:</b>\n"
-        for name, age, telegram, problem, custom_problem, created_at in stats[
-                'recent_requests'][:5]:
-            if problem == CallbackData.CUSTOM and custom_problem:
-                problem_display = f"Своя: {custom_problem[:30]}..."
-            else:
-                problem_display = PROBLEM_NAMES.get(problem, problem)
-            stats_text += f"• {name} ({age} лет) - @{telegram} - {problem_display}\n"
+    await message.answer(stats_text)
 
-    stats_text += f"\n⏰ <i>Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</i>"
 
-    await message.answer(stats_text)
+@router.message(Command("stats", "export"))
+async def command_admin_denied(message: types.Message):
+    """Отказ в административных командах для всех, кроме админа"""
+    await message.answer("⛔ <b>У вас нет прав для выполнения этой команды.</b>")
 
 
 @router.message(Command("help"))
 async def command_help(message: types.Message):
     """Показать справку"""
-    help_text = (
-        "📚 <b>СПРАВКА ПО КОМАНДАМ</b>\n\n"
-        "🎯 <b>Для всех пользователей:</b>\n"
-        "• /start - Начать работу с ботом\n"
-        "• /help - Показать эту справку\n\n"
-        "🎯 <b>Основные действия (через меню):</b>\n"
-        "• 🎁 Получить бесплатный гайд - получить PDF-гайд и выбрать проблему\n"
-        "• 📞 Записаться на консультацию - прямой переход к записи\n"
-        "• ℹ️  О психологе - информация о специалисте\n\n"
-        "🔄 <b>Автоворонка:</b>\n"
-        "1. Получите гайд\n"
-        "2. Выберите проблему (или опишите свою)\n"
-        "3. Укажите имя, возраст и Telegram username\n"
-        "4. Оставьте заявку на бесплатную консультацию\n\n"
-        "📝 <b>О проблемах:</b>\n"
-        "• Можно выбрать из предложенных вариантов\n"
-        "• Или подробно описать свою ситуацию\n\n"
-        "👨‍💼 <b>Административные команды:</b>\n"
-        "• /stats - Статистика бота\n"
-        "• /export - Экспорт базы данных в Excel\n\n"
-        "<i>Консультации проходят в Telegram для вашего удобства.</i>")
-
-    await message.answer(help_text)
+    await message.answer(HELP_TEXT)
 
 
 @router.message(Command("test"))
 async def command_test(message: types.Message):
     """Тестовая команда"""
-    await message.answer("✅ <b>Тест пройден успешно!</b>\n\n"
-                         "Бот работает корректно.")
+    await message.answer(TEST_TEXT)
 
 
-@router.message()
+# Незарегистрированные команды и нетекстовые сообщения игнорируем без ответа
+@router.message(F.text & ~F.text.startswith("/"))
 async def handle_other_messages(message: types.Message):
-    """Обработчик всех остальных сообщений"""
-    await message.answer(
-        "🤖 <b>Я — бот-помощник психолога.</b>\n\n"
-        "Чтобы начать работу, нажмите /start или выберите действие в меню.\n\n"
-        "Для справки нажмите /help",
-        reply_markup=create_main_keyboard())
+    """Обработчик всех остальных текстовых сообщений"""
+    await message.answer(FALLBACK_TEXT, reply_markup=MAIN_KEYBOARD)
 
 
 # ========== ЗАПУСК БОТА ==========
+def prepare_database():
+    """Инициализация и обновление БД (выполняется в отдельном потоке)"""
+    init_database()
+    update_database_schema()
+
+
+async def notify_admin_startup():
+    """Уведомление администратора о запуске бота"""
+    startup_text = STARTUP_TEMPLATE.format(ts=_now_str())
+    try:
+        await bot.send_message(chat_id=CFG.admin_id, text=startup_text)
+        logger.info(
+            f"📨 Уведомление о запуске отправлено администратору {CFG.admin_id}"
+        )
+    except Exception as e:
+        logger.error(f"❌ Не удалось отправить уведомление админу: {e}")
+
+
 async def on_startup():
     """Действия при запуске"""
-    logger.info("=" * 50)
-    logger.info("🚀 ЗАПУСК TELEGRAM-БОТА ДЛЯ ПСИХОЛОГА")
-    logger.info("=" * 50)
+    # Баннер одной записью: одна блокировка логгера и одна запись в поток
+    logger.info("\n".join(
+        ["=" * 50, "🚀 ЗАПУСК TELEGRAM-БОТА ДЛЯ ПСИХОЛОГА", "=" * 50]))
+
+    # База данных и уведомление админу независимы — выполняем параллельно
+    startup_tasks = [_db(prepare_database)]
+    if CFG.admin_id:
+        startup_tasks.append(notify_admin_startup())
+
+    results = await asyncio.gather(*startup_tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"❌ Ошибка при запуске: {result}")
+
+    # Наличие файлов уже проверено при импорте — здесь нет обращений к диску
+    demo_files = [(GUIDE_PDF, GUIDE_EXISTS), (WELCOME_PHOTO, WELCOME_EXISTS)]
+    for file, exists in demo_files:
+        if not exists:
+            logger.warning(f"⚠️  Демо файл {file} не найден")
 
-    # Инициализация и обновление БД
-    init_database()
+    logger.info("\n".join(["✅ Бот инициализирован и готов к работе!", "=" * 50]))
 
-    if ADMIN_ID:
-        try:
-            await bot.send_message(
-                chat_id=ADMIN_ID,
-                text=
-                ("🤖 <b>Бот психолога успешно запущен!</b>\n\n"
-                 f"⏰ <b>Время запуска:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                 "📍 <b>Платформа:</b> Replit\n"
-                 "✅ <b>Статус:</b> Активен и готов к работе\n\n"
-                 "<i>Для проверки работы отправьте боту /start</i>"))
-            logger.info(
-                f"📨 Уведомление о запуске отправлено администратору {ADMIN_ID}"
-            )
-        except Exception as e:
-            logger.error(f"❌ Не удалось отправить уведомление админу: {e}")
 
-    demo_files = ["guide.pdf", "welcome.jpg"]
-    for file in demo_files:
-        if not os.path.exists(file):
-            logger.warning(f"⚠️  Демо файл {file} не найден")
+async def run_webhook():
+    """Прием обновлений через webhook вместо long polling"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot,
+                         secret_token=CFG.webhook_secret).register(
+                             app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
 
-    logger.info("✅ Бот инициализирован и готов к работе!")
-    logger.info("=" * 50)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host="0.0.0.0", port=CFG.webhook_port)
+
+    logger.info(f"🌐 Запуск webhook на порту {CFG.webhook_port}...")
+    await site.start()
+    try:
+        # Регистрируем webhook только когда порт уже слушает — иначе первые
+        # обновления от Telegram уйдут в пустоту
+        await bot.set_webhook(f"{CFG.webhook_url}{WEBHOOK_PATH}",
+                              secret_token=CFG.webhook_secret,
+                              allowed_updates=dp.resolve_used_update_types(),
+                              drop_pending_updates=True)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main():
     """Основная функция запуска"""
+    if CFG.debug:
+        # Встроенный отладочный режим asyncio пишет в лог каждый колбэк,
+        # занявший event loop дольше порога, с указанием места вызова
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = SLOW_CALLBACK_THRESHOLD
+        logger.warning("🐞 Отладка event loop включена (порог %.0f мс)",
+                       SLOW_CALLBACK_THRESHOLD * 1000)
+
     try:
         await on_startup()
 
-        await bot.delete_webhook(drop_pending_updates=True)
+        if CFG.webhook_url:
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
 
-        logger.info("🔄 Запуск поллинга...")
-        await dp.start_polling(bot)
+            logger.info("🔄 Запуск поллинга...")
+            await dp.start_polling(bot)
 
     except KeyboardInterrupt:
         logger.info("⏹️  Бот остановлен пользователем")
+    except asyncio.CancelledError:
+        # Отмена — штатное завершение, отчет админу не отправляем
+        raise
     except Exception as e:
         logger.error(f"❌ Критическая ошибка: {e}")
-        if ADMIN_ID:
+        if CFG.admin_id:
             try:
-                await bot.send_message(
-                    ADMIN_ID,
-                    f"❌ <b>Бот упал с ошибкой:</b>\n\n<code>{str(e)[:1000]}</code>"
-                )
-            except:
+                await asyncio.wait_for(
+                    bot.send_message(
+                        CFG.admin_id,
+                        f"❌ <b>Бот упал с ошибкой:</b>\n\n<code>{str(e)[:1000]}</code>"
+                    ),
+                    timeout=CRASH_NOTIFY_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("⚠️  Отчет о падении не отправлен: истек таймаут")
+            except Exception:
                 pass
         raise
+    finally:
+        # Закрываем HTTP-сессию явно: в webhook-режиме поллинг ее не закроет
+        await bot.session.close()
 
 
 # ========== ТОЧКА ВХОДА ==========
 if __name__ == "__main__":
+    # uvloop — event loop на libuv; на Windows его нет, там остается asyncio
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("ℹ️  uvloop недоступен, используется стандартный asyncio")
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt: